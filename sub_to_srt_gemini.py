@@ -1,11 +1,87 @@
 import os
 import sys
 import time
+import asyncio
+import threading
+import concurrent.futures
+import functools
 import json
 import re
-from typing import List, Tuple, Dict, Optional
+import codecs
+import random
+import hashlib
+import shelve
+import dbm
+from typing import Callable, Iterator, List, Tuple, Dict, Optional
 from dataclasses import dataclass
-import google.generativeai as genai
+
+# google.generativeai pulls in the whole google-api-core/gRPC stack, so it is
+# imported on first use rather than when the CLI starts
+genai = None
+
+def _genai():
+    """Import google.generativeai on first use"""
+    global genai
+    if genai is None:
+        import google.generativeai as genai
+    return genai
+
+class EmptyResponseError(Exception):
+    """Raised when Gemini returns a response without text"""
+
+class IncompleteResponseError(Exception):
+    """Raised when a response is missing translations for some subtitles"""
+
+# One SUB record: "start,end" timestamp line followed by non-blank text lines
+_TS_RE = re.compile(
+    r'^[^\S\n]*(\d+:\d+:[\d.]+)[^\S\n]*,[^\S\n]*(\d+:\d+:[\d.]+)[^\S\n]*\n'
+    r'((?:[^\S\n]*\S[^\n]*(?:\n|\Z))+)',
+    re.M
+)
+
+# SUB timestamp: H:MM:SS with optional fractional seconds
+_SUB_TIME = re.compile(r'^\s*(\d+):(\d+):(\d+)(?:\.(\d+))?\s*$')
+
+# Newline plus surrounding horizontal whitespace (including CR): splitting on
+# it yields already-trimmed lines
+_NL = re.compile(r'[^\S\n]*\n[^\S\n]*')
+
+# Response parsing patterns
+_SUB_HDR = re.compile(r'字幕(\d+):')
+_BRACKETS = re.compile(r'^\[|\]$')
+_SEQ_LINE = re.compile(r'字幕(\d+):\s*(.+)')
+
+# Low temperature keeps wording stable across chunks, retries and languages
+TRANSLATION_TEMPERATURE = 0.2
+
+# JSON-mode config for single-language requests: [{"idx": N, "text": "..."}]
+SEQUENTIAL_GENERATION_CONFIG = {
+    "temperature": TRANSLATION_TEMPERATURE,
+    "response_mime_type": "application/json",
+    "response_schema": {
+        "type": "ARRAY",
+        "items": {
+            "type": "OBJECT",
+            "properties": {
+                "idx": {"type": "INTEGER"},
+                "text": {"type": "STRING"},
+            },
+            "required": ["idx", "text"],
+        },
+    },
+}
+
+def _retryable_errors() -> tuple:
+    """Transient errors worth retrying; anything else fails immediately"""
+    from google.api_core import exceptions as google_exceptions
+    return (
+        google_exceptions.ResourceExhausted,
+        google_exceptions.ServiceUnavailable,
+        google_exceptions.DeadlineExceeded,
+        google_exceptions.InternalServerError,
+        EmptyResponseError,
+        IncompleteResponseError,
+    )
 
 @dataclass
 class SubtitleEntry:
@@ -20,8 +96,50 @@ class TranslationResult:
     success: bool
     error_message: Optional[str] = None
 
+class TokenBucket:
+    """Token-bucket rate limiter allowing bursts up to capacity"""
+    
+    def __init__(self, capacity: float, refill_rate_per_sec: float):
+        self.capacity = capacity
+        self.refill_rate_per_sec = refill_rate_per_sec
+        self.tokens = capacity
+        self.last_refill = time.monotonic()
+        # Guards only the bookkeeping below and is never held while sleeping,
+        # so it is safe to share between the sync and async paths
+        self._lock = threading.Lock()
+    
+    def _reserve(self) -> float:
+        """Take one token and return how long the caller must wait for it"""
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity,
+                              self.tokens + (now - self.last_refill) * self.refill_rate_per_sec)
+            self.last_refill = now
+            
+            # Tokens may go negative: the deficit is the queue of reserved requests
+            self.tokens -= 1
+            if self.tokens >= 0:
+                return 0.0
+            return -self.tokens / self.refill_rate_per_sec
+    
+    def acquire(self):
+        """Block until a token is available"""
+        wait_time = self._reserve()
+        if wait_time > 0:
+            print(f"Rate limiting: waiting {wait_time:.1f} seconds...")
+            time.sleep(wait_time)
+    
+    async def acquire_async(self):
+        """Wait for a token without blocking the event loop"""
+        wait_time = self._reserve()
+        if wait_time > 0:
+            print(f"Rate limiting: waiting {wait_time:.1f} seconds...")
+            await asyncio.sleep(wait_time)
+
 class SubToSrtGeminiTranslator:
-    def __init__(self, api_key: str = None):
+    def __init__(self, api_key: str = None, max_concurrency: int = 4,
+                 rate_limit_capacity: int = 10, requests_per_minute: float = 10,
+                 use_cache: bool = True, cache_path: str = None, token_budget: int = 30000):
         self.api_key = api_key or os.getenv('GEMINI_API_KEY1')
         if not self.api_key:
             raise ValueError(
@@ -29,8 +147,8 @@ class SubToSrtGeminiTranslator:
                 "or pass api_key parameter."
             )
         
-        genai.configure(api_key=self.api_key)
-        self.model = genai.GenerativeModel('gemini-2.5-flash-preview-05-20')
+        self.model_name = 'gemini-2.5-flash-preview-05-20'
+        self._model = None  # Created on first use, see the model property
         
         # Language mappings
         self.languages = {
@@ -43,110 +161,225 @@ class SubToSrtGeminiTranslator:
             'de': 'German'
         }
         
-        # Rate limiting
-        self.last_request_time = 0
-        self.min_request_interval = 1.0  # Minimum seconds between requests
+        # Rate limiting (defaults match the free tier of Gemini 2.5 Flash Preview: 10 RPM)
+        self.bucket = TokenBucket(rate_limit_capacity, requests_per_minute / 60)
+        
+        # Estimated input+output tokens allowed per simultaneous request
+        # (conservative limit for the free tier)
+        self.token_budget = token_budget
+        
+        # Persistent translation cache keyed by (text, language, model)
+        self.use_cache = use_cache
+        self.cache_path = cache_path or os.path.expanduser('~/.cache/zimaku_sub/translations')
+        
+        # Rendered prompt text around the subtitles, keyed by target language(s)
+        self._prompt_cache: Dict = {}
+        
+        # Token counts from the API, keyed by a digest of the counted text
+        self._token_cache: Dict[bytes, int] = {}
+        
+        # Maximum number of in-flight requests for concurrent translation
+        self.max_concurrency = max_concurrency
+    
+    @property
+    def model(self):
+        """Gemini model, configured on first use"""
+        if self._model is None:
+            genai = _genai()
+            genai.configure(api_key=self.api_key)
+            self._model = genai.GenerativeModel(self.model_name)
+        return self._model
+    
+    def _detect_encoding(self, raw: bytes) -> str:
+        """Guess the SUB file encoding from its BOM or first 64 KiB"""
+        if raw.startswith(codecs.BOM_UTF8):
+            return 'utf-8-sig'
+        if raw.startswith((codecs.BOM_UTF16_LE, codecs.BOM_UTF16_BE)):
+            return 'utf-16'
+        
+        try:
+            # Incremental decode tolerates a multi-byte character cut at the boundary
+            codecs.getincrementaldecoder('utf-8')().decode(raw[:65536], final=False)
+            return 'utf-8'
+        except UnicodeDecodeError:
+            return 'shift_jis'
     
     def parse_sub_file(self, file_path: str) -> List[SubtitleEntry]:
         """Parse SUB file and extract subtitle entries"""
-        subtitles = []
+        with open(file_path, 'rb') as file:
+            raw = file.read()
         
+        encoding = self._detect_encoding(raw)
         try:
-            with open(file_path, 'r', encoding='utf-8') as file:
-                lines = file.readlines()
+            content = raw.decode(encoding)
         except UnicodeDecodeError:
-            with open(file_path, 'r', encoding='shift_jis') as file:
-                lines = file.readlines()
+            # Non-UTF-8 bytes only appeared past the sniffed prefix
+            content = raw.decode('shift_jis')
         
-        i = 0
-        while i < len(lines):
-            line = lines[i].strip()
-            
-            if not line:
-                i += 1
-                continue
-            
-            # Check if line contains timestamp
-            if ',' in line and '.' in line:
-                times = line.split(',')
-                if len(times) == 2:
-                    start_time = times[0].strip()
-                    end_time = times[1].strip()
-                    
-                    # Get subtitle text (next non-empty line)
-                    i += 1
-                    text = ""
-                    while i < len(lines) and lines[i].strip():
-                        text += lines[i].strip()
-                        i += 1
-                    
-                    if text:
-                        subtitles.append(SubtitleEntry(start_time, end_time, text))
-                    continue
-            
-            i += 1
-        
-        return subtitles
+        # _TS_RE treats CR as horizontal whitespace, so CRLF files need no conversion
+        return [
+            SubtitleEntry(start_time, end_time, ''.join(_NL.split(text.strip())))
+            for start_time, end_time, text in _TS_RE.findall(content)
+        ]
     
-    def convert_time_format(self, time_str: str) -> str:
+    @staticmethod
+    @functools.lru_cache(maxsize=4096)
+    def convert_time_format(time_str: str) -> str:
         """Convert SUB time format to SRT time format"""
-        time_str = time_str.strip()
-        parts = time_str.split(':')
-        
-        if len(parts) != 3:
-            return time_str
+        match = _SUB_TIME.match(time_str)
+        if not match:
+            return time_str.strip()
         
-        hours = parts[0]
-        minutes = parts[1]
-        sec_parts = parts[2].split('.')
-        seconds = sec_parts[0]
-        
-        if len(sec_parts) > 1:
-            milliseconds = sec_parts[1][:3].ljust(3, '0')
-        else:
-            milliseconds = "000"
+        hours, minutes, seconds, fraction = match.groups()
+        milliseconds = (fraction or '')[:3].ljust(3, '0')
         
         return f"{hours}:{minutes}:{seconds},{milliseconds}"
     
     def estimate_tokens(self, text: str) -> int:
-        """Rough estimation of tokens for text"""
-        # Rough estimation: 1 token ≈ 0.75 words for Japanese
-        return len(text.split()) + len(text) // 4
+        """Count tokens for text with Gemini's tokenizer, cached by content"""
+        key = hashlib.blake2b(text.encode('utf-8'), digest_size=16).digest()
+        tokens = self._token_cache.get(key)
+        if tokens is None:
+            try:
+                tokens = self.model.count_tokens(text).total_tokens
+            except Exception:
+                # Offline fallback: Japanese runs at up to one token per character,
+                # the same conservative estimate _chunk sizes chunks with
+                return len(text)
+            self._token_cache[key] = tokens
+        return tokens
     
     def rate_limit_wait(self):
         """Implement rate limiting"""
-        current_time = time.time()
-        time_since_last = current_time - self.last_request_time
+        self.bucket.acquire()
+    
+    async def rate_limit_wait_async(self):
+        """Implement rate limiting without blocking the event loop"""
+        await self.bucket.acquire_async()
+    
+    def _retry_delay(self, error: Exception, attempt: int, base: float = 1.0) -> float:
+        """Backoff before the next attempt, honoring a server-provided delay"""
+        # gRPC errors carry google.rpc.RetryInfo in their details
+        for detail in getattr(error, 'details', None) or []:
+            retry_delay = getattr(detail, 'retry_delay', None)
+            if retry_delay is not None:
+                return retry_delay.seconds + retry_delay.nanos / 1e9
         
-        if time_since_last < self.min_request_interval:
-            wait_time = self.min_request_interval - time_since_last
-            print(f"Rate limiting: waiting {wait_time:.1f} seconds...")
-            time.sleep(wait_time)
+        # REST errors may carry a Retry-After header
+        response = getattr(error, 'response', None)
+        retry_after = (getattr(response, 'headers', None) or {}).get('Retry-After')
+        if retry_after:
+            try:
+                return float(retry_after)
+            except ValueError:
+                pass
         
-        self.last_request_time = time.time()
+        return min(60, base * 2 ** attempt) + random.uniform(0, base)
     
-    def translate_batch_simultaneous(self, subtitles: List[SubtitleEntry], 
-                                   target_languages: List[str]) -> Dict[str, TranslationResult]:
-        """Translate all subtitles to multiple languages in one request"""
+    async def _with_retry_async(self, fn, max_attempts: int = 5):
+        """Await fn(), retrying transient errors with exponential backoff and jitter"""
+        for attempt in range(max_attempts):
+            try:
+                return await fn()
+            except _retryable_errors() as e:
+                if attempt == max_attempts - 1:
+                    raise
+                delay = self._retry_delay(e, attempt)
+                print(f"Request failed ({e}), retrying in {delay:.1f} seconds "
+                      f"({attempt + 1}/{max_attempts - 1})...")
+                await asyncio.sleep(delay)
+    
+    def _cache_key(self, text: str, lang: str) -> str:
+        """Cache key for one subtitle translation"""
+        return hashlib.sha1(f"{text}|{lang}|{self.model_name}".encode('utf-8')).hexdigest()
+    
+    def _cache_lookup(self, subtitles: List[SubtitleEntry], 
+                      target_languages: List[str]) -> Dict[str, Dict[int, str]]:
+        """Return cached translations per language, keyed by subtitle index"""
+        hits = {lang: {} for lang in target_languages}
+        if not self.use_cache:
+            return hits
         
-        # Prepare the text
-        subtitle_text = ""
-        for i, subtitle in enumerate(subtitles, 1):
-            subtitle_text += f"字幕{i}: {subtitle.text}\n"
+        try:
+            with shelve.open(self.cache_path, flag='r') as cache:
+                for lang in target_languages:
+                    for i, subtitle in enumerate(subtitles):
+                        translation = cache.get(self._cache_key(subtitle.text, lang))
+                        if translation is not None:
+                            hits[lang][i] = translation
+        except dbm.error:
+            # No cache written yet
+            pass
+        except OSError as e:
+            print(f"Warning: Could not read translation cache: {e}")
         
-        # Estimate tokens
-        input_tokens = self.estimate_tokens(subtitle_text)
-        estimated_output = input_tokens * len(target_languages) * 1.5
+        return hits
+    
+    def _cache_store(self, entries: List[Tuple[str, str, str]]):
+        """Save (text, lang, translation) entries to the cache"""
+        if not self.use_cache or not entries:
+            return
         
-        print(f"Estimated tokens: Input={input_tokens}, Output≈{estimated_output}, Total≈{input_tokens + estimated_output}")
+        try:
+            os.makedirs(os.path.dirname(self.cache_path), exist_ok=True)
+            with shelve.open(self.cache_path) as cache:
+                for text, lang, translation in entries:
+                    cache[self._cache_key(text, lang)] = translation
+        except (OSError, dbm.error) as e:
+            print(f"Warning: Could not write translation cache: {e}")
+    
+    def _unique_by_text(self, subtitles: List[SubtitleEntry], indices: List[int]) -> List[SubtitleEntry]:
+        """First subtitle for each distinct text among indices, in order"""
+        unique = {}
+        for i in indices:
+            unique.setdefault(subtitles[i].text, subtitles[i])
+        return list(unique.values())
+    
+    def _merge_translations(self, subtitles: List[SubtitleEntry], cached: Dict[int, str],
+                            translated: Dict[str, str]) -> List[str]:
+        """Fan cached and freshly translated texts back out to every subtitle"""
+        return [
+            cached[i] if i in cached else translated.get(subtitle.text, "")
+            for i, subtitle in enumerate(subtitles)
+        ]
+    
+    def _build_corpus(self, subtitles: List[SubtitleEntry]) -> str:
+        """Number subtitles from 字幕1 as the prompt body"""
+        return '\n'.join(f"字幕{i}: {subtitle.text}" for i, subtitle in enumerate(subtitles, 1)) + '\n'
+    
+    def _chunk(self, subtitles: List[SubtitleEntry], 
+               max_input_tokens: int = 4000) -> List[List[SubtitleEntry]]:
+        """Greedily pack subtitles into chunks that fit the input token budget"""
+        # Japanese runs at up to one token per character, so the character
+        # count is a cheap, conservative stand-in for re-tokenizing every chunk
+        chunks = []
+        current = []
+        current_size = 0
+        
+        for subtitle in subtitles:
+            size = len(subtitle.text) + 8  # "字幕N: " label and newline
+            if current and current_size + size > max_input_tokens:
+                chunks.append(current)
+                current = []
+                current_size = 0
+            current.append(subtitle)
+            current_size += size
         
-        if input_tokens + estimated_output > 30000:  # Conservative limit for free tier
-            print("Warning: Estimated token usage is high. Consider using batch mode.")
+        if current:
+            chunks.append(current)
+        
+        return chunks
+    
+    def _simultaneous_prompt_frame(self, target_languages: Tuple[str, ...]) -> Tuple[str, str]:
+        """Static text before and after the subtitles in a multi-language prompt"""
+        frame = self._prompt_cache.get(target_languages)
+        if frame is not None:
+            return frame
         
-        # Prepare language list
         lang_names = [self.languages.get(lang, lang) for lang in target_languages]
+        example = ', '.join(f'"{lang}": "翻訳"' for lang in target_languages)
         
-        prompt = f"""
+        head = f"""
 以下の日本語字幕を以下の言語に翻訳してください：
 {', '.join([f"{i+1}. {name}" for i, name in enumerate(lang_names)])}
 
@@ -154,158 +387,379 @@ class SubToSrtGeminiTranslator:
 専門用語や固有名詞は適切に翻訳し、各言語の文化的ニュアンスに配慮してください。
 
 字幕テキスト：
-{subtitle_text}
+"""
+        tail = f"""
 
 出力形式（必須）：
-字幕1:
-- {lang_names[0]}: [翻訳]
-{f"- {lang_names[1]}: [翻訳]" if len(lang_names) > 1 else ""}
-{f"- {lang_names[2]}: [翻訳]" if len(lang_names) > 2 else ""}
+JSON配列のみを出力してください。各要素は字幕番号 "idx" と、言語コードをキーとする翻訳を持ちます。
+言語コード: {', '.join(f'"{lang}" = {name}' for lang, name in zip(target_languages, lang_names))}
+[{{"idx": 1, {example}}}, {{"idx": 2, {example}}}, ...]
+"""
+        frame = self._prompt_cache[target_languages] = (head, tail)
+        return frame
+    
+    def _sequential_prompt_frame(self, lang: str) -> Tuple[str, str]:
+        """Static text before and after the subtitles in a single-language prompt"""
+        frame = self._prompt_cache.get(lang)
+        if frame is not None:
+            return frame
+        
+        lang_name = self.languages.get(lang, lang)
+        
+        head = f"""
+以下の日本語字幕を{lang_name}に翻訳してください。
+
+全体の文脈を考慮し、一貫性のある自然な翻訳を行ってください。
+専門用語や固有名詞は適切に翻訳し、{lang_name}の文化的ニュアンスに配慮してください。
 
-字幕2:
-- {lang_names[0]}: [翻訳]
-{f"- {lang_names[1]}: [翻訳]" if len(lang_names) > 1 else ""}
-{f"- {lang_names[2]}: [翻訳]" if len(lang_names) > 2 else ""}
+字幕テキスト：
+"""
+        tail = """
 
-(続く...)
+出力形式（必須）：
+JSON配列のみを出力してください。各要素は字幕番号 "idx" と翻訳 "text" を持ちます。
+[{"idx": 1, "text": "翻訳"}, {"idx": 2, "text": "翻訳"}, ...]
 """
+        frame = self._prompt_cache[lang] = (head, tail)
+        return frame
+    
+    def _simultaneous_generation_config(self, target_languages: List[str]) -> dict:
+        """JSON-mode config returning one object per subtitle with a field per language"""
+        properties = {"idx": {"type": "INTEGER"}}
+        properties.update({lang: {"type": "STRING"} for lang in target_languages})
+        return {
+            "temperature": TRANSLATION_TEMPERATURE,
+            "response_mime_type": "application/json",
+            "response_schema": {
+                "type": "ARRAY",
+                "items": {
+                    "type": "OBJECT",
+                    "properties": properties,
+                    "required": list(properties),
+                },
+            },
+        }
+    
+    def translate_batch_simultaneous(self, subtitles: List[SubtitleEntry], 
+                                   target_languages: List[str]) -> Dict[str, TranslationResult]:
+        """Translate all subtitles to multiple languages, one request per chunk"""
         
-        try:
-            self.rate_limit_wait()
-            print("Sending request to Gemini 2.5 Pro...")
-            
-            response = self.model.generate_content(prompt)
-            
-            if not response.text:
-                raise Exception("Empty response from Gemini API")
-            
-            print("Parsing response...")
-            return self._parse_simultaneous_response(response.text, target_languages, len(subtitles))
-            
-        except Exception as e:
-            error_msg = f"Simultaneous translation failed: {str(e)}"
-            print(error_msg)
+        # Only subtitles missing from the cache for some language are sent
+        cached = self._cache_lookup(subtitles, target_languages)
+        miss_indices = [i for i in range(len(subtitles))
+                        if any(i not in cached[lang] for lang in target_languages)]
+        
+        if not miss_indices:
+            print("All translations found in cache")
+            return {
+                lang: TranslationResult(
+                    language=lang,
+                    translations=self._merge_translations(subtitles, cached[lang], {}),
+                    success=True
+                )
+                for lang in target_languages
+            }
+        
+        if len(miss_indices) < len(subtitles):
+            print(f"Cache: {len(subtitles) - len(miss_indices)}/{len(subtitles)} subtitles already translated")
+        
+        # Repeated lines are sent once and fanned back out afterwards
+        misses = self._unique_by_text(subtitles, miss_indices)
+        if len(misses) < len(miss_indices):
+            print(f"Deduplicated: {len(misses)} unique texts for {len(miss_indices)} subtitles")
+        
+        # Estimate tokens
+        corpus = self._build_corpus(misses)
+        input_tokens = self.estimate_tokens(corpus)
+        estimated_output = input_tokens * len(target_languages) * 1.5
+        
+        print(f"Estimated tokens: Input={input_tokens}, Output≈{estimated_output}, Total≈{input_tokens + estimated_output}")
+        
+        # One request covers everything unless its estimated input plus output
+        # exceeds the budget; then split into concurrently translated chunks
+        max_input_tokens = int(self.token_budget / (1 + 1.5 * len(target_languages)))
+        if input_tokens <= max_input_tokens:
+            chunks = [misses]
+            corpora = [corpus]
+        else:
+            chunks = self._chunk(misses, max_input_tokens)
+            corpora = [self._build_corpus(chunk) for chunk in chunks]
+            print(f"Split into {len(chunks)} chunks")
+        
+        chunk_results = asyncio.run(self._translate_chunks_async(chunks, corpora, target_languages))
+        
+        # Concatenate per-language chunk results in order
+        results = {}
+        cache_entries = []
+        for lang in target_languages:
+            translated = {}
+            errors = []
+            for n, (chunk, chunk_result) in enumerate(zip(chunks, chunk_results), 1):
+                result = chunk_result[lang]
+                if result.success:
+                    # Successful chunks are cached even if another chunk failed
+                    for subtitle, translation in zip(chunk, result.translations):
+                        translated[subtitle.text] = translation
+                        cache_entries.append((subtitle.text, lang, translation))
+                elif len(chunks) > 1:
+                    errors.append(f"chunk {n}/{len(chunks)}: {result.error_message}")
+                else:
+                    errors.append(result.error_message)
             
-            # Return error results for all languages
-            results = {}
-            for lang in target_languages:
+            if errors:
                 results[lang] = TranslationResult(
                     language=lang,
                     translations=[],
                     success=False,
-                    error_message=error_msg
+                    error_message="; ".join(errors)
                 )
-            return results
+            else:
+                results[lang] = TranslationResult(
+                    language=lang,
+                    translations=self._merge_translations(subtitles, cached[lang], translated),
+                    success=True
+                )
+        
+        self._cache_store(cache_entries)
+        
+        return results
+    
+    async def _translate_chunks_async(self, chunks: List[List[SubtitleEntry]], corpora: List[str], 
+                                      target_languages: List[str]) -> List[Dict[str, TranslationResult]]:
+        """Translate each chunk to all languages, bounded by max_concurrency"""
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+        generation_config = self._simultaneous_generation_config(target_languages)
+        prompt_head, prompt_tail = self._simultaneous_prompt_frame(tuple(target_languages))
+        
+        async def _translate_chunk(chunk: List[SubtitleEntry], corpus: str) -> Dict[str, TranslationResult]:
+            # Each chunk's corpus is numbered independently from 字幕1
+            prompt = f"{prompt_head}{corpus}{prompt_tail}"
+            last_parsed = None
+            
+            async def _request():
+                nonlocal last_parsed
+                async with semaphore:
+                    await self.rate_limit_wait_async()
+                    response = await self.model.generate_content_async(
+                        prompt, generation_config=generation_config)
+                
+                if not response.text:
+                    raise EmptyResponseError("Empty response from Gemini API")
+                
+                # A response that skipped entries for any language is retried as a whole
+                print("Parsing response...")
+                last_parsed = self._parse_simultaneous_response(response.text, target_languages, len(chunk))
+                failed = [f"{lang}: {result.error_message}"
+                          for lang, result in last_parsed.items() if not result.success]
+                if failed:
+                    raise IncompleteResponseError("; ".join(failed))
+                return last_parsed
+            
+            try:
+                print("Sending request to Gemini 2.5 Pro...")
+                return await self._with_retry_async(_request)
+                
+            except Exception as e:
+                error_msg = f"Simultaneous translation failed: {str(e)}"
+                print(error_msg)
+                
+                # Keep the languages the last response did complete
+                if last_parsed is not None:
+                    return last_parsed
+                
+                # Return error results for all languages
+                return {
+                    lang: TranslationResult(
+                        language=lang,
+                        translations=[],
+                        success=False,
+                        error_message=error_msg
+                    )
+                    for lang in target_languages
+                }
+        
+        return await asyncio.gather(*[_translate_chunk(chunk, corpus)
+                                     for chunk, corpus in zip(chunks, corpora)])
     
     def translate_batch_sequential(self, subtitles: List[SubtitleEntry], 
                                  target_languages: List[str]) -> Dict[str, TranslationResult]:
-        """Translate to each language sequentially"""
-        results = {}
+        """Translate to each language with one request per language, sent concurrently"""
+        return asyncio.run(self.translate_batch_sequential_async(subtitles, target_languages))
+    
+    async def translate_batch_sequential_async(self, subtitles: List[SubtitleEntry], 
+                                               target_languages: List[str],
+                                               queue: Optional[asyncio.Queue] = None) -> Dict[str, TranslationResult]:
+        """Fan out per-language requests, bounded by max_concurrency.
         
-        # Prepare the text once
-        subtitle_text = ""
-        for i, subtitle in enumerate(subtitles, 1):
-            subtitle_text += f"字幕{i}: {subtitle.text}\n"
+        Await this directly when already running inside an event loop, where
+        translate_batch_sequential's asyncio.run() is not allowed. If a queue
+        is given, each (lang, result) pair is put on it as soon as it is ready.
+        """
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+        cached = self._cache_lookup(subtitles, target_languages)
+        cache_entries = []
+        # Languages with the same cache misses share one corpus string
+        corpora = {}
         
-        for lang in target_languages:
+        async def _translate_one(lang: str) -> TranslationResult:
             lang_name = self.languages.get(lang, lang)
             
-            prompt = f"""
-以下の日本語字幕を{lang_name}に翻訳してください。
-
-全体の文脈を考慮し、一貫性のある自然な翻訳を行ってください。
-専門用語や固有名詞は適切に翻訳し、{lang_name}の文化的ニュアンスに配慮してください。
-
-字幕テキスト：
-{subtitle_text}
-
-出力形式（必須）：
-字幕1: [翻訳]
-字幕2: [翻訳]
-字幕3: [翻訳]
-(続く...)
-"""
+            # Only subtitles missing from the cache are sent
+            miss_indices = [i for i in range(len(subtitles)) if i not in cached[lang]]
+            if not miss_indices:
+                print(f"✓ {lang_name} translation found in cache")
+                return TranslationResult(
+                    language=lang,
+                    translations=self._merge_translations(subtitles, cached[lang], {}),
+                    success=True
+                )
+            
+            misses = self._unique_by_text(subtitles, miss_indices)
+            key = tuple(miss_indices)
+            corpus = corpora.get(key)
+            if corpus is None:
+                corpus = corpora[key] = self._build_corpus(misses)
+            
+            prompt_head, prompt_tail = self._sequential_prompt_frame(lang)
+            prompt = f"{prompt_head}{corpus}{prompt_tail}"
+            
+            async def _request():
+                async with semaphore:
+                    await self.rate_limit_wait_async()
+                    response = await self.model.generate_content_async(
+                        prompt, generation_config=SEQUENTIAL_GENERATION_CONFIG)
+                
+                if not response.text:
+                    raise EmptyResponseError("Empty response from Gemini API")
+                
+                # A response that skipped entries is retried as a whole
+                translations = self._parse_sequential_response(response.text, len(misses))
+                missing = translations.count(None)
+                if missing:
+                    raise IncompleteResponseError(
+                        f"Expected {len(misses)} translations, got {len(misses) - missing}")
+                return translations
             
             try:
-                self.rate_limit_wait()
                 print(f"Translating to {lang_name}...")
+                translations = await self._with_retry_async(_request)
                 
-                response = self.model.generate_content(prompt)
+                translated = {}
+                for subtitle, translation in zip(misses, translations):
+                    translated[subtitle.text] = translation
+                    cache_entries.append((subtitle.text, lang, translation))
+                translations = self._merge_translations(subtitles, cached[lang], translated)
                 
-                if not response.text:
-                    raise Exception("Empty response from Gemini API")
+                print(f"✓ {lang_name} translation completed ({len(misses)} entries translated)")
                 
-                translations = self._parse_sequential_response(response.text, len(subtitles))
-                
-                results[lang] = TranslationResult(
+                return TranslationResult(
                     language=lang,
                     translations=translations,
                     success=True
                 )
                 
-                print(f"✓ {lang_name} translation completed ({len(translations)} entries)")
-                
             except Exception as e:
                 error_msg = f"Translation to {lang_name} failed: {str(e)}"
                 print(f"✗ {error_msg}")
                 
-                results[lang] = TranslationResult(
+                return TranslationResult(
                     language=lang,
                     translations=[],
                     success=False,
                     error_message=error_msg
                 )
         
+        async def _translate_and_publish(lang: str) -> TranslationResult:
+            try:
+                result = await _translate_one(lang)
+            except Exception as e:
+                result = TranslationResult(
+                    language=lang,
+                    translations=[],
+                    success=False,
+                    error_message=f"Translation to {self.languages.get(lang, lang)} failed: {str(e)}"
+                )
+            if queue is not None:
+                await queue.put((lang, result))
+            return result
+        
+        outcomes = await asyncio.gather(*[_translate_and_publish(lang) for lang in target_languages])
+        results = dict(zip(target_languages, outcomes))
+        
+        self._cache_store(cache_entries)
+        
         return results
     
+    def _load_json_rows(self, response_text: str) -> Optional[List[dict]]:
+        """Decode a JSON-mode response into row objects, or None if it isn't JSON"""
+        try:
+            data = json.loads(response_text)
+        except ValueError:
+            return None
+        
+        if not isinstance(data, list):
+            return None
+        return [row for row in data if isinstance(row, dict)]
+    
     def _parse_simultaneous_response(self, response_text: str, target_languages: List[str], 
                                    num_subtitles: int) -> Dict[str, TranslationResult]:
         """Parse simultaneous translation response"""
         results = {}
         
-        # Initialize results
+        # Initialize results with one slot per subtitle; None marks a missing
+        # entry, while an empty string is a legitimate (blank) translation
         for lang in target_languages:
             results[lang] = TranslationResult(
                 language=lang,
-                translations=[],
+                translations=[None] * num_subtitles,
                 success=False
             )
         
         try:
-            # Split response by subtitle entries
-            lines = response_text.split('\n')
+            rows = self._load_json_rows(response_text)
+            if rows is not None:
+                for row in rows:
+                    index = row.get('idx')
+                    # Rows without a usable number are skipped and counted as missing
+                    if not isinstance(index, int) or not 0 < index <= num_subtitles:
+                        continue
+                    index -= 1
+                    for lang in target_languages:
+                        translation = row.get(lang)
+                        if isinstance(translation, str):
+                            results[lang].translations[index] = translation.strip()
+            
+            # Fall back to the plain-text "- <Language>: <text>" format
+            lines = _NL.split(response_text.strip()) if rows is None else []
             current_subtitle = -1
+            prefix_map = {f'- {self.languages.get(lang, lang)}:': lang for lang in target_languages}
             
             for line in lines:
-                line = line.strip()
-                
                 # Check for subtitle header
-                subtitle_match = re.match(r'字幕(\d+):', line)
+                subtitle_match = _SUB_HDR.match(line)
                 if subtitle_match:
                     current_subtitle = int(subtitle_match.group(1)) - 1
                     continue
                 
-                # Check for translations
-                for i, lang in enumerate(target_languages):
-                    lang_name = self.languages.get(lang, lang)
-                    if line.startswith(f'- {lang_name}:'):
-                        translation = line.replace(f'- {lang_name}:', '').strip()
-                        # Remove brackets if present
-                        translation = re.sub(r'^\[|\]$', '', translation)
-                        
-                        # Ensure we have enough entries
-                        while len(results[lang].translations) <= current_subtitle:
-                            results[lang].translations.append("")
-                        
-                        if current_subtitle >= 0:
-                            results[lang].translations[current_subtitle] = translation
+                # Check for translations: "- <Language>: <text>"
+                colon = line.find(':')
+                if colon < 0:
+                    continue
+                lang = prefix_map.get(line[:colon + 1])
+                if lang is None or not 0 <= current_subtitle < num_subtitles:
+                    continue
+                
+                # Remove brackets if present
+                translation = _BRACKETS.sub('', line[colon + 1:].strip())
+                results[lang].translations[current_subtitle] = translation
             
             # Mark successful translations
             for lang in target_languages:
-                if len(results[lang].translations) == num_subtitles:
+                translated = num_subtitles - results[lang].translations.count(None)
+                if translated == num_subtitles:
                     results[lang].success = True
                 else:
-                    results[lang].error_message = f"Expected {num_subtitles} translations, got {len(results[lang].translations)}"
+                    results[lang].error_message = f"Expected {num_subtitles} translations, got {translated}"
             
         except Exception as e:
             for lang in target_languages:
@@ -313,53 +767,80 @@ class SubToSrtGeminiTranslator:
         
         return results
     
-    def _parse_sequential_response(self, response_text: str, num_subtitles: int) -> List[str]:
-        """Parse sequential translation response"""
-        translations = []
-        lines = response_text.split('\n')
+    def _parse_sequential_response(self, response_text: str, num_subtitles: int) -> List[Optional[str]]:
+        """Parse sequential translation response into one slot per subtitle"""
+        # Entries are placed by their number, so a skipped entry leaves a None
+        # slot instead of shifting every later translation; an empty string
+        # is a legitimate (blank) translation, not a missing one
+        translations = [None] * num_subtitles
         
-        for line in lines:
-            line = line.strip()
-            
-            # Look for numbered subtitle entries
-            match = re.match(r'字幕\d+:\s*(.+)', line)
-            if match:
-                translation = match.group(1)
-                # Remove brackets if present
-                translation = re.sub(r'^\[|\]$', '', translation)
-                translations.append(translation)
+        rows = self._load_json_rows(response_text)
+        if rows is not None:
+            for row in rows:
+                index = row.get('idx')
+                text = row.get('text')
+                # Rows without a usable number are skipped and counted as missing
+                if isinstance(index, int) and 0 < index <= num_subtitles and isinstance(text, str):
+                    translations[index - 1] = text.strip()
+            return translations
         
-        # If regex didn't work, try line-by-line
-        if len(translations) < num_subtitles:
-            translations = []
-            for line in lines:
-                line = line.strip()
-                if line and not line.startswith('字幕') and ':' in line:
-                    # Extract text after colon
-                    translation = line.split(':', 1)[1].strip()
+        # Fall back to the plain-text "字幕N: <text>" format
+        for line in _NL.split(response_text.strip()):
+            match = _SEQ_LINE.match(line)
+            if match:
+                index = int(match.group(1)) - 1
+                if 0 <= index < num_subtitles:
                     # Remove brackets if present
-                    translation = re.sub(r'^\[|\]$', '', translation)
-                    if translation:
-                        translations.append(translation)
+                    translations[index] = _BRACKETS.sub('', match.group(2))
         
         return translations
     
+    def _srt_timings(self, subtitles: List[SubtitleEntry]) -> List[str]:
+        """SRT timing line for each subtitle, shared by every output language"""
+        return [
+            f"{self.convert_time_format(subtitle.start_time)} --> {self.convert_time_format(subtitle.end_time)}\n"
+            for subtitle in subtitles
+        ]
+    
+    def _srt_parts(self, timings: List[str], translations: List[str]) -> Iterator[str]:
+        """Yield SRT content as one string fragment per entry"""
+        return (
+            f"{i}\n{timing}{translation}\n\n"
+            for i, (timing, translation) in enumerate(zip(timings, translations), 1)
+        )
+    
     def create_srt_content(self, subtitles: List[SubtitleEntry], translations: List[str]) -> str:
         """Create SRT format content"""
-        srt_content = ""
+        return ''.join(self._srt_parts(self._srt_timings(subtitles), translations))
+    
+    def write_srt(self, subtitles: List[SubtitleEntry], translations: List[str], path: str,
+                  timings: Optional[List[str]] = None):
+        """Stream SRT entries straight to path without building the whole file in memory"""
+        if timings is None:
+            timings = self._srt_timings(subtitles)
+        with open(path, 'w', encoding='utf-8', buffering=1 << 16) as file:
+            file.writelines(self._srt_parts(timings, translations))
+    
+    async def _translate_and_write_async(self, subtitles: List[SubtitleEntry], target_languages: List[str],
+                                         write_one: Callable[[Tuple[str, TranslationResult]], Optional[str]]
+                                         ) -> Tuple[Dict[str, TranslationResult], List[Optional[str]]]:
+        """Write each language's SRT as soon as it arrives, while other requests are in flight"""
+        queue = asyncio.Queue()
+        written = {}
         
-        for i, (subtitle, translation) in enumerate(zip(subtitles, translations), 1):
-            start_srt = self.convert_time_format(subtitle.start_time)
-            end_srt = self.convert_time_format(subtitle.end_time)
-            
-            srt_content += f"{i}\n"
-            srt_content += f"{start_srt} --> {end_srt}\n"
-            srt_content += f"{translation}\n\n"
+        async def _consumer():
+            for _ in target_languages:
+                lang, result = await queue.get()
+                written[lang] = await asyncio.to_thread(write_one, (lang, result))
         
-        return srt_content
+        results, _ = await asyncio.gather(
+            self.translate_batch_sequential_async(subtitles, target_languages, queue),
+            _consumer()
+        )
+        return results, [written[lang] for lang in results]
     
     def convert_sub_to_srt(self, input_file: str, target_languages: List[str], 
-                          mode: str = 'batch', output_dir: str = None):
+                          mode: str = 'simultaneous', output_dir: str = None):
         """Main conversion function"""
         
         if not os.path.exists(input_file):
@@ -394,25 +875,32 @@ class SubToSrtGeminiTranslator:
         print(f"Target languages: {[self.languages[lang] for lang in valid_languages]}")
         print(f"Translation mode: {mode}")
         
-        # Perform translation
-        if mode == 'simultaneous':
+        timings = self._srt_timings(subtitles)
+        
+        def _write_one_srt(item: Tuple[str, TranslationResult]) -> Optional[str]:
+            lang, result = item
+            if not (result.success and len(result.translations) == len(subtitles)):
+                return None
+            
+            output_file = os.path.join(output_dir, f"{base_name}_{lang}.srt")
+            self.write_srt(subtitles, result.translations, output_file, timings)
+            return output_file
+        
+        # Perform translation and generate output files
+        if mode == 'batch':
+            # Each language is written as soon as its request returns
+            results, output_files = asyncio.run(
+                self._translate_and_write_async(subtitles, valid_languages, _write_one_srt))
+        else:  # simultaneous mode
             results = self.translate_batch_simultaneous(subtitles, valid_languages)
-        else:  # batch mode
-            results = self.translate_batch_sequential(subtitles, valid_languages)
+            
+            # All languages arrive together; write them in parallel, map() keeps language order
+            with concurrent.futures.ThreadPoolExecutor(max_workers=min(8, len(results))) as executor:
+                output_files = list(executor.map(_write_one_srt, results.items()))
         
-        # Generate output files
         successful_translations = 0
-        
-        for lang, result in results.items():
-            if result.success and len(result.translations) == len(subtitles):
-                # Create SRT file
-                srt_content = self.create_srt_content(subtitles, result.translations)
-                
-                output_file = os.path.join(output_dir, f"{base_name}_{lang}.srt")
-                
-                with open(output_file, 'w', encoding='utf-8') as file:
-                    file.write(srt_content)
-                
+        for (lang, result), output_file in zip(results.items(), output_files):
+            if output_file:
                 print(f"✓ Created: {output_file}")
                 successful_translations += 1
             else:
@@ -500,19 +988,19 @@ def interactive_mode():
     
     # 翻訳モード選択
     print("\n翻訳モードを選択してください:")
-    print("1. 順次翻訳 (安全・推奨)")
-    print("2. 同時翻訳 (高速・リスクあり)")
+    print("1. 同時翻訳 (高速・推奨)")
+    print("2. 順次翻訳 (言語ごとに個別リクエスト)")
     
     while True:
         mode_choice = input("番号を入力してください (デフォルト: 1): ").strip()
         if mode_choice == "" or mode_choice == "1":
-            mode = "batch"
-            print("✅ 順次翻訳モードを選択しました")
-            break
-        elif mode_choice == "2":
             mode = "simultaneous"
             print("✅ 同時翻訳モードを選択しました")
             break
+        elif mode_choice == "2":
+            mode = "batch"
+            print("✅ 順次翻訳モードを選択しました")
+            break
         else:
             print("❌ 1または2を入力してください。")
     
@@ -568,7 +1056,7 @@ def main():
         print("\n翻訳を開始します...")
         try:
             translator = SubToSrtGeminiTranslator()
-            translator.convert_sub_to_srt(input_file, target_languages, 'batch')
+            translator.convert_sub_to_srt(input_file, target_languages, 'simultaneous')
             print("\n🎉 翻訳完了！")
         except Exception as e:
             print(f"\n❌ エラー: {e}")
@@ -593,7 +1081,7 @@ def main():
         print()
         print("コマンドライン例:")
         print("  python sub_to_srt_gemini.py sample.sub en,ko,zh-tw")
-        print("  python sub_to_srt_gemini.py sample.sub en --mode simultaneous")
+        print("  python sub_to_srt_gemini.py sample.sub en,ko --mode batch")
         print()
         print("対話モードを開始しますか？ (y/n)")
         if input().lower().startswith('y'):
@@ -605,9 +1093,10 @@ def main():
     target_languages = [lang.strip() for lang in languages_str.split(',')]
     
     # Parse options
-    mode = 'batch'
+    mode = 'simultaneous'
     output_dir = None
     api_key = None
+    use_cache = True
     
     i = 3
     while i < len(sys.argv):
@@ -620,11 +1109,14 @@ def main():
         elif sys.argv[i] == '--api-key' and i + 1 < len(sys.argv):
             api_key = sys.argv[i + 1]
             i += 2
+        elif sys.argv[i] == '--no-cache':
+            use_cache = False
+            i += 1
         else:
             i += 1
     
     try:
-        translator = SubToSrtGeminiTranslator(api_key=api_key)
+        translator = SubToSrtGeminiTranslator(api_key=api_key, use_cache=use_cache)
         translator.convert_sub_to_srt(input_file, target_languages, mode, output_dir)
     except ValueError as e:
         print(f"Error: {e}")